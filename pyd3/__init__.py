@@ -1,7 +1,7 @@
 """
 Oliver June 2024
 """
-from .tags import get_tags, Mp3Tag
+from .tags import get_tags, get_tags_batch, clear_cache, Mp3Tag
 
-__all__ = ["get_tags", "Mp3Tag"]
+__all__ = ["get_tags", "get_tags_batch", "clear_cache", "Mp3Tag"]
 __version__ = "1.0.0"
@@ -1,13 +1,21 @@
 """
 Oliver June 2024
+
+get_tags is thread safe: files are parsed independently and the opt-in cache of
+parsed tags is shared between threads, get_tags_batch parses many files on a thread pool
 """
 from __future__ import annotations
 
-import re
+import mmap
+import os
 import string
-from typing import List, Dict, Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from typing import Dict, Any, Iterable, Iterator
 
-__all__ = ["get_tags", "Mp3Tag"]
+__all__ = ["get_tags", "get_tags_batch", "clear_cache", "Mp3Tag"]
 
 DEFAULT_ENCODING = 'ISO-8859-1'  # standard mp3 text encoding
 JPEG_SOI_MARKER = b'\xFF\xD8'  # start of image marker for jpeg files
@@ -16,65 +24,58 @@ ID3v2_HEADER_LENGTH = 10
 IDENTIFIER_LEN = 3
 TAG_SIZE_START_IDX = 6
 TAG_OFFSET = 10
-INT_KEYS = ('track_number', 'disc_number', 'year')
-ARTIST_KEYS = ("composer", "artist1", "artist2")
+MMAP_THRESHOLD = 64 * 1024  # smaller tags are cheaper to read than to map
+CACHE_SIZE = 128  # number of parsed files kept by get_tags(cache=True)
+HAS_FADVISE = hasattr(os, 'posix_fadvise')  # page cache hints, not available on Windows/macOS
 NULL = '\x00'
+# bytes that decode (ISO-8859-1) to characters outside string.printable, stripped from text frames
+NON_PRINTABLE = bytes(i for i in range(256) if chr(i) not in string.printable)
 
-FRAME_IDS = [b'TIT2', b'TALB', b'TPUB', b'TCON', b'TYER', b'TRCK',
-             b'TOPS', b'TPE1', b'TPE2', b'TCOM', b'APIC', b'COMM', b'WXXX']
 FRAME_ENCODING = {
     0: 'ISO-8859-1', 1: 'UTF-16', 2: 'UTF-16BE', 3: 'UTF-8'
 }
-METADATA_MAP = {
-    b'TIT2': 'title', b'TALB': 'album', b'TPUB': 'publisher', b'TCON': 'genre',
-    b'TYER': 'year', b'TRCK': 'track_number', b'TOPS': 'disc_number', b'TPE1': 'artist1',
-    b'TPE2': 'artist2', b'TCOM': 'composer', b'APIC': 'artwork', b'COMM': 'comments', b'WXXX': 'url'
+# kinds of frame content, decide how a frame is extracted and stored on Mp3Tag
+TEXT, INT, TRACK, ARTIST, IMAGE = range(5)
+# frame id -> (attribute name, content kind)
+FRAME_DISPATCH = {
+    b'TIT2': ('title', TEXT), b'TALB': ('album', TEXT), b'TPUB': ('publisher', TEXT), b'TCON': ('genre', TEXT),
+    b'TYER': ('year', INT), b'TRCK': ('track_number', TRACK), b'TOPS': ('disc_number', INT),
+    b'TPE1': ('artist1', ARTIST), b'TPE2': ('artist2', ARTIST), b'TCOM': ('composer', ARTIST),
+    b'APIC': ('artwork', IMAGE), b'COMM': ('comments', TEXT), b'WXXX': ('url', TEXT)
 }
 
 
+@dataclass(slots=True, frozen=True)
 class Mp3Tag:
     """
-    object
+    object, attributes of frames missing from the tag are None
     """
-    album: str
-    artists: List[str]  # comprised of composer, artist1 and artist2 from mp3 tag
-    artwork: bytes
-    comments: str
-    genre: str
-    publisher: str
-    title: str
-    track_number: int
-    disc_number: int
-    url: str
-    year: int
+    album: str | None = None
+    artists: tuple[str, ...] = ()  # comprised of composer, artist1 and artist2 from mp3 tag
+    artwork: bytes | memoryview | None = None  # view into the copied picture frame, .tobytes() for bytes
+    comments: str | None = None
+    genre: str | None = None
+    publisher: str | None = None
+    title: str | None = None
+    track_number: int | None = None
+    disc_number: int | None = None
+    url: str | None = None
+    year: int | None = None
+
+    def __reduce__(self):
+        # memoryviews can't be pickled, send the artwork as bytes
+        artwork = self.artwork.tobytes() if isinstance(self.artwork, memoryview) else self.artwork
+        return Mp3Tag, tuple(artwork if f.name == 'artwork' else getattr(self, f.name) for f in fields(self))
 
 
-def decode_synchsafe(x: int | bytes) -> int:
+def decode_synchsafe(x: bytes) -> int:
     """
-    decode bytes/int from synchronization safe format to integer
+    decode 4 bytes from synchronization safe format to integer
     https://phoxis.org/2010/05/08/synch-safe/
-    :param x: synchsafe value
+    :param x: synchsafe bytes (MSB of each byte is always zero per the ID3v2 spec)
     :return: integer
     """
-    if isinstance(x, bytes):
-        x = int.from_bytes(x)
-
-    if x & 0x808080:
-        # ignore MSB
-        x &= 0x7f7f7f7f
-
-    ans = 0
-    a = x & 0xff
-    b = (x >> 8) & 0xff
-    c = (x >> 16) & 0xff
-    d = (x >> 24) & 0xff
-
-    ans |= a
-    ans |= b << 7
-    ans |= c << 14
-    ans |= d << 21
-
-    return ans
+    return (x[0] << 21) | (x[1] << 14) | (x[2] << 7) | x[3]
 
 
 def extract_text(data: bytes) -> str:
@@ -83,56 +84,79 @@ def extract_text(data: bytes) -> str:
     :param data: byte data
     :return: string
     """
-    x = data.decode(DEFAULT_ENCODING)
-    res = []
-    for c in x:
-        if c in string.printable:
-            res.append(c)
-    return ''.join(res)
+    return data.translate(None, NON_PRINTABLE).decode(DEFAULT_ENCODING)
 
 
-def extract_image_data(data: bytes, tag: bytes) -> bytes | None:
+def extract_image_data(data: bytes) -> memoryview | None:
     """
        extract image byte data from mp3 file frame
        https://docs.fileformat.com/image/jpeg/
        :param data: frame data
-       :param tag: mp3 tag
-       :return: image bytes
+       :return: view of the image bytes within the frame data
        """
-    if data[1:11] != b'image/jpeg':  # check mime type is JPEG
+    if not data.startswith(b'image/jpeg', 1):  # check mime type (after encoding byte) is JPEG
         return None
     # get first instance of jpeg image start
-    img_start = tag.find(JPEG_SOI_MARKER)
+    img_start = data.find(JPEG_SOI_MARKER)
     # get last instance of jpeg image end marker incase of EXIF
-    img_end = tag.rfind(JPEG_EOI_MARKER)
+    img_end = data.rfind(JPEG_EOI_MARKER)
 
-    img_data = tag[img_start:img_end + 2]
+    # slice a view so the image isn't copied a second time out of the frame data
+    img_data = memoryview(data)[img_start:img_end + 2]
     return img_data
 
 
-def get_frame_data(tag: bytes, frame_id: bytes):
+def get_frame_data(data: bytes, kind: int):
     """
     get frame tag content
-    :param tag: the tag bytes
-    :param frame_id: the frame identifier
+    :param data: the frame data
+    :param kind: the frame content kind
     :return: content
     """
-    start_idx = tag.find(frame_id)
-    if start_idx == -1:
-        return None
-    offset = start_idx + TAG_OFFSET
-    header = tag[start_idx:offset]
-    size = decode_synchsafe(header[4:8])
-    data = tag[offset:offset + size]
     # extract desired content from bytes data
-    if frame_id == b'APIC':
-        content = extract_image_data(data, tag)
+    if kind == IMAGE:
+        content = extract_image_data(data)
     else:
         content = extract_text(data)
 
     return content
 
 
+def get_frames(tag: bytes, version: int, offset: int = 0, unsynchronised: bool = False) -> Dict[bytes, Any]:
+    """
+    walk the tag frame by frame, collecting the content of known frames
+    :param tag: the tag bytes
+    :param version: ID3v2 major version
+    :param offset: index of the first frame header
+    :param unsynchronised: the tag header says all v2.4 frames are unsynchronised
+    :return: dictionary of frame ids and content
+    """
+    frames = dict.fromkeys(FRAME_DISPATCH)
+    while offset + TAG_OFFSET <= len(tag):
+        frame_id = tag[offset:offset + 4]
+        if frame_id[0] == 0:
+            break  # reached the padding after the last frame
+        b = tag[offset + 4:offset + 8]
+        if version == 4:
+            size = decode_synchsafe(b)
+        else:
+            # ID3v2.3 frame sizes are plain big-endian integers
+            size = (b[0] << 24) | (b[1] << 16) | (b[2] << 8) | b[3]
+        # v2.4 sizes count the stored (unsynchronised) bytes, so undo it per frame
+        unsync = version == 4 and (unsynchronised or tag[offset + 9] & 0x02)
+        offset += TAG_OFFSET  # skip id, size and 2 flag bytes
+        entry = FRAME_DISPATCH.get(frame_id)
+        # keep the first usable occurrence of repeated frames
+        if entry is not None and frames[frame_id] is None:
+            data = tag[offset:offset + size]
+            if unsync:
+                data = data.replace(b'\xff\x00', b'\xff')
+            frames[frame_id] = get_frame_data(data, entry[1])
+        offset += size
+
+    return frames
+
+
 def format_tags(frames: Dict[bytes, Any]) -> Mp3Tag:
     """
     tag frames collected in dictionary and
@@ -140,43 +164,164 @@ def format_tags(frames: Dict[bytes, Any]) -> Mp3Tag:
     :param frames: dictionary of frame names and data
     :return:
     """
-    tag = Mp3Tag()
+    fields = dict()
     artists = set()
     for k, v in frames.items():
-        key = METADATA_MAP[k]
-        if key in ARTIST_KEYS and v is not None:
+        if v is None:
+            continue  # frame missing, attribute keeps its default
+        key, kind = FRAME_DISPATCH[k]
+        if kind == ARTIST:
             artists.add(v)
             continue
-        if key in INT_KEYS and v is not None:
-            v = v.split('/')[0] if key == "track_number" else int(v)
+        if kind == INT:
+            try:
+                v = int(v)
+            except ValueError:
+                continue  # malformed number, attribute keeps its default
+        elif kind == TRACK:
+            v = v.split('/')[0]
+
+        fields[key] = v
+
+    return Mp3Tag(artists=tuple(artists), **fields)
+
+
+def parse_tag(tag: bytes | mmap.mmap, header: bytes, offset: int) -> Mp3Tag:
+    """
+    parse the frames of an mp3 tag
+    :param tag: the tag bytes
+    :param header: the ID3v2 header
+    :param offset: index of the tag body within tag
+    :return: Mp3Tags object of mp3 file tag attributes
+    """
+    version = header[3]
+    unsynchronised = bool(header[5] & 0x80)
+    if unsynchronised and version < 4:
+        # v2.3 sizes count the bytes after resynchronisation, undo it for the whole tag first
+        # (slicing copies so this also works on an mmap)
+        tag = tag[offset:].replace(b'\xff\x00', b'\xff')
+        offset = 0
+    ext_size = tag[offset:offset + 4]
+    if header[5] & 0x40 and len(ext_size) == 4:
+        # skip the extended header, its size field is synchsafe and inclusive only in v2.4
+        offset += decode_synchsafe(ext_size) if version == 4 else 4 + int.from_bytes(ext_size, 'big')
 
-        tag.__setattr__(key, v)
+    return format_tags(get_frames(tag, version, offset, unsynchronised))
 
-    tag.artists = list(artists)
-    return tag
+
+def read_fd(fd: int, size: int) -> bytes:
+    """
+    read size bytes from a file descriptor, os.read may return less in one call
+    :param fd: file descriptor
+    :param size: number of bytes
+    :return: bytes read, shorter only at end of file
+    """
+    chunks = []
+    while size > 0:
+        chunk = os.read(fd, size)
+        if not chunk:
+            break  # end of file
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
 
 
-def get_tags(filename: str) -> Mp3Tag | None:
+def read_tags(filename: str) -> Mp3Tag | None:
     """
+    read and parse the tag of an mp3 file
     :param filename: mp3 filename
     :return: Mp3Tags object of mp3 file tag attributes
     """
-    # read data
-    file = open(filename, "rb")
-    # check if ID3v2 file (first 3 bytes should be ID3)
-    if file.read(3) != b'ID3':
-        return None
-    file.seek(6)  # skip to metadata tag size
-    # get the size of the tag
-    size = decode_synchsafe(file.read(4))
-    # get the mp3 tag
-    tag = file.read(size)
-    frames = dict()
+    fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        header = read_fd(fd, ID3v2_HEADER_LENGTH)
+        # check if ID3v2 file (first 3 bytes should be ID3)
+        if len(header) < ID3v2_HEADER_LENGTH or header[:IDENTIFIER_LEN] != b'ID3':
+            return None
+        # get the size of the tag
+        size = decode_synchsafe(header[TAG_SIZE_START_IDX:ID3v2_HEADER_LENGTH])
+        try:
+            if size >= MMAP_THRESHOLD:
+                # map large tags (usually embedded artwork) so only the frames we extract are copied
+                try:
+                    mm = mmap.mmap(fd, ID3v2_HEADER_LENGTH + size, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    pass  # e.g. truncated file, read what is there instead
+                else:
+                    with mm:
+                        return parse_tag(mm, header, ID3v2_HEADER_LENGTH)
+            # get the mp3 tag
+            tag = read_fd(fd, size)
+        finally:
+            if HAS_FADVISE:
+                # the tag has been read, let the OS evict its pages
+                os.posix_fadvise(fd, 0, ID3v2_HEADER_LENGTH + size, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+    return parse_tag(tag, header, 0)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _get_cached_tags(filename: str, mtime_ns: int, file_size: int) -> Mp3Tag | None:
+    """
+    cached read_tags, mtime_ns and file_size only key the cache
+    :param filename: absolute mp3 filename
+    :param mtime_ns: file modification time in nanoseconds
+    :param file_size: file size in bytes
+    :return: Mp3Tags object of mp3 file tag attributes
+    """
+    return read_tags(filename)
+
+
+def clear_cache():
+    """
+    drop every Mp3Tag kept by get_tags(cache=True), releasing their artwork
+    """
+    _get_cached_tags.cache_clear()
 
-    for frame_id in FRAME_IDS:
-        # check for frame in tag
-        frames[frame_id] = get_frame_data(tag, frame_id)
 
-    file.close()
+def get_tags(filename: str, cache: bool = False) -> Mp3Tag | None:
+    """
+    with cache=True results are kept per file until its modification time or size
+    changes, so repeated calls for an unchanged file return the same (shared) object.
+    cached objects hold their artwork, so up to CACHE_SIZE images stay in memory until
+    evicted or released with clear_cache()
+    :param filename: mp3 filename
+    :param cache: reuse the result of an earlier call for the same unchanged file
+    :return: Mp3Tags object of mp3 file tag attributes
+    """
+    if not cache:
+        return read_tags(filename)
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    return _get_cached_tags(path, st.st_mtime_ns, st.st_size)
+
+
+def get_tags_batch(filenames: Iterable[str], workers: int = 8, cache: bool = False) -> Iterator[Mp3Tag | None]:
+    """
+    get the tags of many files at once, reading is I/O bound so files are parsed on
+    a pool of threads which run while others wait on the disk.
+    results are yielded as they are consumed and at most 2 * workers files are parsed
+    ahead, so memory doesn't grow with the number of files.
+    files that can't be read (missing, no permission...) give None instead of
+    aborting the whole batch, malformed numeric frames are left as None like in get_tags
+    :param filenames: mp3 filenames
+    :param workers: number of threads
+    :param cache: passed on to get_tags
+    :return: iterator of Mp3Tags objects (or None) in the same order as filenames
+    """
+    def get_tags_or_none(filename: str) -> Mp3Tag | None:
+        try:
+            return get_tags(filename, cache)
+        except OSError:
+            return None
 
-    return format_tags(frames)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for filename in filenames:
+            pending.append(executor.submit(get_tags_or_none, filename))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()